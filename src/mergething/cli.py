@@ -3,14 +3,62 @@
 CLI for mergething - IPython history merging tool
 """
 import argparse
+import os
 import shutil
 import socket
+import sqlite3
 import time
 from pathlib import Path
 
 from .ipython import merge_histories, cleanup_old_files
 
 
+def _fast_copy(src, dst):
+    """Copy src to dst like shutil.copy2, but through the kernel.
+
+    os.copy_file_range avoids Python-level read/write buffering and is
+    O(1) on filesystems that support reflinks (btrfs, xfs). Falls back to
+    shutil.copyfile where it is unavailable or fails (e.g. cross-device).
+    """
+    copied = False
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if n == 0:
+                        break
+                    remaining -= n
+            copied = remaining == 0
+        except OSError:
+            copied = False
+    if not copied:
+        shutil.copyfile(src, dst)
+    shutil.copystat(src, dst)
+
+
+def _snapshot_db(src, dst):
+    """Snapshot the SQLite database at src to dst.
+
+    VACUUM INTO writes a consistent, compacted copy in a single
+    transaction even while the source is in use (e.g. a running IPython),
+    and the final os.replace is atomic, so dst never holds a torn copy.
+    Falls back to a byte copy on SQLite builds without VACUUM INTO
+    (< 3.27).
+    """
+    tmp = str(dst) + ".tmp"
+    try:
+        conn = sqlite3.connect(f"file:{src}?mode=ro", uri=True)
+        try:
+            conn.execute("VACUUM INTO ?", (tmp,))
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        _fast_copy(src, tmp)
+    os.replace(tmp, dst)
+
+
 def merge_command(args):
     """Handle the merge command"""
     source_files = [Path(f) for f in args.sources]
@@ -65,12 +113,14 @@ def init_command(args):
     timestamp = int(time.time())
     target_file = target_dir / f"ipython_history_{hostname}_0_{timestamp}.db"
 
-    # Copy the file
-    shutil.copy2(source_file, target_file)
+    # Snapshot the history database rather than copying its bytes, since
+    # a running IPython may be writing to it
+    _snapshot_db(source_file, target_file)
     print(f"Copied history to {target_file}")
     
     # Create a marker file to indicate this file is completed
-    marker_file = target_dir / f"{target_file.name}.completed"
+    marker_file = target_dir / "completed" / f"{target_file.name}.completed"
+    marker_file.parent.mkdir(exist_ok=True)
     marker_file.touch()
     print(f"Created completion marker: {marker_file}")
 
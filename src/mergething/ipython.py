@@ -3,12 +3,17 @@
 IPython History Sync - Sync IPython history across multiple machines
 """
 import os
+import re
 import sqlite3
+import struct
 import time
 import socket
 import atexit
+import hashlib
 import platform
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
 from pathlib import Path
 from typing import List, Optional, Union
 
@@ -49,61 +54,284 @@ def is_process_running(pid: int) -> bool:
         return True
 
 
+# Completion markers live in their own subdirectory so the hot scans of
+# the sync directory only list actual history files. Markers written by
+# older versions next to their files are still honored.
+_COMPLETED_DIR = "completed"
+
+
+def _scan_marker_names(sync_dir: Path, prefix: str = "ipython_history_") -> dict:
+    """Map marker file names to their paths, old and new location alike"""
+    markers = {}
+    try:
+        with os.scandir(sync_dir / _COMPLETED_DIR) as entries:
+            for entry in entries:
+                if entry.name.startswith(prefix):
+                    markers[entry.name] = Path(entry.path)
+    except FileNotFoundError:
+        pass
+    return markers
+
+
+# Matches ipython_history_{hostname}_{pid}_{timestamp}.db; the pid part is
+# optional to accept files written by older versions without one
+_NAME_RE = re.compile(r'^ipython_history_(?P<host>.+?)_(?:(?P<pid>\d+)_)?(?P<ts>\d+)\.db$')
+
+
+def _parse_filename(name: str, _cache={}):
+    """Parse (hostname, pid, timestamp) out of a history file name.
+
+    Returns None if the name doesn't match the naming convention. Results
+    are memoized since the same names get parsed by several functions
+    (and twice per sort comparison) on every run.
+    """
+    try:
+        return _cache[name]
+    except KeyError:
+        pass
+
+    match = _NAME_RE.match(name)
+    if match is None:
+        parsed = None
+    else:
+        pid = match.group('pid')
+        parsed = (match.group('host'), int(pid) if pid else None, int(match.group('ts')))
+    _cache[name] = parsed
+    return parsed
+
+
 def get_safe_files_for_merge(sync_dir: Path, current_file: Path) -> List[Path]:
     """Get files that are definitely safe to read"""
     safe_files = []
     current_hostname = socket.gethostname()
 
-    # 1. Files that have a .completed marker (these are guaranteed safe)
-    for marker_file in sync_dir.glob("ipython_history_*.db.completed"):
-        # Get the original file name by removing .completed suffix
-        original_file = sync_dir / marker_file.name.replace(".completed", "")
-        if original_file.exists() and original_file != current_file:
-            safe_files.append(original_file)
+    # List the directory once with scandir and classify by name; globbing
+    # twice stats every entry per pattern, which adds up on sync
+    # directories with hundreds of rotated files
+    with os.scandir(sync_dir) as entries:
+        names = {e.name for e in entries if e.name.startswith("ipython_history_")}
+
+    marker_names = set(_scan_marker_names(sync_dir))
+    marker_names.update(n for n in names if n.endswith(".db.completed"))
 
-    # 2. Regular files from other machines (safe due to Syncthing atomicity)
-    for file_path in sync_dir.glob("ipython_history_*.db"):
+    for name in names:
+        if not name.endswith(".db"):
+            continue
+        file_path = sync_dir / name
         if file_path == current_file:
             continue
 
-        try:
-            # Parse hostname from filename: ipython_history_{hostname}_{pid}_{timestamp}.db
-            parts = file_path.stem.split('_')
-            if len(parts) >= 4:
-                hostname = parts[2]
-                if hostname != current_hostname:
-                    safe_files.append(file_path)
-        except (ValueError, IndexError):
+        # 1. Files that have a .completed marker (these are guaranteed safe)
+        if f"{name}.completed" in marker_names:
+            safe_files.append(file_path)
             continue
 
+        # 2. Regular files from other machines (safe due to Syncthing atomicity)
+        # Parse hostname from filename: ipython_history_{hostname}_{pid}_{timestamp}.db
+        parsed = _parse_filename(name)
+        if parsed is not None and parsed[0] != current_hostname:
+            safe_files.append(file_path)
+
     # Sort files by (is_this_machine, timestamp) in reverse order
     # This puts this machine's files first, and within each machine, newest files first
-    def sort_key(file_path):
-        try:
-            # Extract hostname and timestamp from filename
-            parts = file_path.stem.split('_')
-            if len(parts) >= 4:
-                hostname = parts[2]
-                timestamp = int(parts[-1])
-                is_this_machine = (hostname == current_hostname)
-                # Return tuple for sorting: (is_this_machine, timestamp)
-                # We negate is_this_machine so True (1) comes before False (0) when reversed
-                return (is_this_machine, timestamp)
-        except (ValueError, IndexError):
+    # Decorate-sort-undecorate: compute each key once up front so the
+    # sort itself is a plain tuple compare
+    decorated = []
+    for file_path in safe_files:
+        parsed = _parse_filename(file_path.name)
+        if parsed is None:
             # Fallback for files that don't match the expected pattern
-            return (False, 0)
+            key = (False, 0)
+        else:
+            # We negate is_this_machine so True (1) comes before False (0) when reversed
+            key = (parsed[0] == current_hostname, parsed[2])
+        decorated.append((key, file_path))
+    decorated.sort(key=itemgetter(0), reverse=True)
+
+    return [file_path for _, file_path in decorated]
+
+
+# Hot statements for merge_histories, defined once so every execution
+# passes the identical string and hits sqlite3's per-connection prepared
+# statement cache instead of re-parsing and re-planning the SQL
+# The ordered subqueries fix the order rows reach the aggregate; SQLite
+# cannot flatten them away because the outer query aggregates
+_SQL_HISTORY_SIGS = '''
+    SELECT session, rowdigest(line, source, source_raw)
+    FROM (SELECT session, line, source, source_raw
+          FROM history ORDER BY session, line)
+    GROUP BY session
+'''
+_SQL_OUTPUT_SIGS = '''
+    SELECT session, rowdigest(line, output)
+    FROM (SELECT session, line, output
+          FROM output_history ORDER BY session, line)
+    GROUP BY session
+'''
+# Rows per multi-row VALUES statement in _bulk_insert
+_INSERT_CHUNK = 50
+
+
+def _bulk_insert(conn, prefix, placeholder, rows) -> None:
+    """Insert rows using multi-row VALUES statements of _INSERT_CHUNK rows.
+
+    Packing many rows into one statement amortizes SQLite's fixed
+    per-statement cost below what executemany alone achieves. Full chunks
+    all share one SQL string and the remainder reuses the single-row
+    form, so only two statements ever get prepared.
+    """
+    full_sql = prefix + ",".join([placeholder] * _INSERT_CHUNK)
+    n_full = len(rows) // _INSERT_CHUNK * _INSERT_CHUNK
+    for i in range(0, n_full, _INSERT_CHUNK):
+        chunk = rows[i:i + _INSERT_CHUNK]
+        conn.execute(full_sql, [value for row in chunk for value in row])
+    if n_full < len(rows):
+        conn.executemany(prefix + placeholder, rows[n_full:])
+
+
+class _RowDigest:
+    """SQL aggregate folding (line, text...) rows into a 16-byte digest.
+
+    Registered via create_aggregate on each source connection, so the
+    per-session signatures come out of a single GROUP BY query instead of
+    pulling and grouping every row in Python. Hashes exactly like
+    _digest_rows.
+    """
 
-    safe_files.sort(key=sort_key, reverse=True)
+    def __init__(self):
+        self.h = hashlib.blake2b(digest_size=16)
 
-    return safe_files
+    def step(self, line, *texts):
+        self.h.update(struct.pack("<q", line))
+        for text in texts:
+            self.h.update((text or "").encode())
+            self.h.update(b"\x00")
+        self.h.update(b"\x01")
+
+    def finalize(self):
+        return self.h.digest()
+
+
+def _digest_rows(rows) -> bytes:
+    """Compute a fixed-size signature for an iterable of (line, text...) rows.
+
+    Streams the rows through blake2b as they arrive, with separator bytes
+    so that no concatenation of fields can collide with a different row
+    split; nothing is materialized in memory.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for row in rows:
+        h.update(struct.pack("<q", row[0]))
+        for text in row[1:]:
+            h.update((text or "").encode())
+            h.update(b"\x00")
+        h.update(b"\x01")
+    return h.digest()
+
+
+# Signature of a session with no rows in a table
+_EMPTY_DIGEST = _digest_rows(())
+
+
+def _file_digest(path) -> str:
+    """Content digest of a file, for spotting byte-identical copies.
+
+    Uses hashlib.file_digest where available (Python 3.11+), which hashes
+    straight from the file without Python-level byte copies.
+    """
+    with open(path, 'rb') as f:
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(f, 'blake2b').hexdigest()[:32]
+        h = hashlib.blake2b()
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+        return h.hexdigest()[:32]
+
+
+def _read_source_sessions(source_file, verbose: bool = True) -> List[dict]:
+    """Read one source file and return its sessions with signatures.
+
+    Each entry holds 'signature', 'metadata', 'source_file' and
+    'orig_session', ordered newest session first. Only reads, on its own
+    connection, so several source files can be read concurrently.
+    """
+    sessions = []
+    try:
+        # Open read-only: a plain connect sets up rollback journals on
+        # the peer's file, leaving -journal sidecars for syncthing to
+        # replicate. immutable=1 lets SQLite skip locking entirely, and
+        # mmap speeds up the sequential scans.
+        source_conn = sqlite3.connect(
+            f"file:{source_file}?mode=ro&immutable=1", uri=True)
+        source_conn.execute("PRAGMA mmap_size=268435456")
+        source_conn.execute("PRAGMA query_only=ON")
+        source_conn.create_aggregate("rowdigest", -1, _RowDigest)
+
+        # Check if output_history table exists
+        cursor = source_conn.execute('''
+            SELECT name FROM sqlite_master
+            WHERE type='table' AND name='output_history'
+        ''')
+        has_output_history = cursor.fetchone() is not None
+
+        # One GROUP BY query per table computes every session's digest;
+        # only (session, digest) pairs cross into Python, never the rows
+        hist_sigs = dict(source_conn.execute(_SQL_HISTORY_SIGS))
+        out_sigs = {}
+        if has_output_history:
+            out_sigs = dict(source_conn.execute(_SQL_OUTPUT_SIGS))
+
+        # Get all sessions from this file in reverse order
+        sessions_cursor = source_conn.execute('''
+            SELECT session, start, end, num_cmds, remark
+            FROM sessions
+            ORDER BY session DESC
+        ''')
+
+        for session_row in sessions_cursor:
+            orig_session, start_time, end_time, num_cmds, remark = session_row
+
+            sessions.append({
+                # Session signature: digests of commands + outputs
+                'signature': (
+                    hist_sigs.get(orig_session, _EMPTY_DIGEST)
+                    + out_sigs.get(orig_session, _EMPTY_DIGEST)
+                ),
+                'metadata': (start_time, end_time, num_cmds, remark),
+                'source_file': source_file,
+                'orig_session': orig_session
+            })
+
+        source_conn.close()
+
+    except sqlite3.Error as e:
+        if verbose:
+            print(f"mergething: Warning: Could not read {source_file}: {e}")
+
+    return sessions
 
 
 def merge_histories(source_files: List[Path], target_file: Path, verbose: bool = True) -> None:
     """Merge SQLite history files preserving session integrity and chronological order"""
     # Create target database with IPython's exact schema
-    target_conn = sqlite3.connect(str(target_file))
-
-    # Use IPython's exact table definitions
+    target_conn = sqlite3.connect(str(target_file), cached_statements=256)
+
+    # Bulk-load settings: no journal or fsyncs at all while building the
+    # target. This is safe because the file is a private scratch database
+    # at this point -- a crash mid-merge just means the next startup
+    # redoes the merge from the peer files. None of these persist for
+    # IPython, which reopens the file with its own defaults.
+    # page_size must be set before the first table is created.
+    target_conn.execute("PRAGMA page_size=65536")
+    target_conn.execute("PRAGMA journal_mode=OFF")
+    target_conn.execute("PRAGMA synchronous=OFF")
+    target_conn.execute("PRAGMA temp_store=MEMORY")
+    target_conn.execute("PRAGMA cache_size=-65536")
+
+    # Use IPython's table definitions, except that the (session, line)
+    # primary keys are created as unique indexes after the bulk load;
+    # loading with the key active pays a B-tree probe and page splits
+    # per inserted row
     target_conn.execute('''
         CREATE TABLE IF NOT EXISTS sessions
         (session integer primary key autoincrement, start timestamp,
@@ -111,24 +339,21 @@ def merge_histories(source_files: List[Path], target_file: Path, verbose: bool =
     ''')
     target_conn.execute('''
         CREATE TABLE IF NOT EXISTS history
-        (session integer, line integer, source text, source_raw text,
-         PRIMARY KEY (session, line))
+        (session integer, line integer, source text, source_raw text)
     ''')
     target_conn.execute('''
         CREATE TABLE IF NOT EXISTS output_history
-        (session integer, line integer, output text,
-         PRIMARY KEY (session, line))
+        (session integer, line integer, output text)
     ''')
 
     # Sort files by creation time for chronological ordering
     files_with_times = []
     for source_file in source_files:
-        try:
-            # Extract timestamp from filename
-            parts = Path(source_file).stem.split('_')
-            timestamp = int(parts[-1])
-            files_with_times.append((timestamp, source_file))
-        except (ValueError, IndexError):
+        # Extract timestamp from filename
+        parsed = _parse_filename(Path(source_file).name)
+        if parsed is not None:
+            files_with_times.append((parsed[2], source_file))
+        else:
             # Fallback to file mtime
             try:
                 timestamp = int(Path(source_file).stat().st_mtime)
@@ -139,115 +364,147 @@ def merge_histories(source_files: List[Path], target_file: Path, verbose: bool =
     # Sort by timestamp (newest first for reverse processing)
     files_with_times.sort(key=lambda x: x[0], reverse=True)
 
-    # Track seen sessions using tuple of all commands + outputs
-    seen_sessions = set()
+    # Track content digests of files already read; syncthing peers often
+    # hold byte-identical copies, which need no second parse
+    seen_files = set()
+    # Session dedup runs inside SQLite: the blob primary key doubles as
+    # the unique index, INSERT OR IGNORE reports via rowcount whether a
+    # signature is new, and with temp_store=MEMORY the digests never
+    # accumulate in a Python set
+    target_conn.execute('''
+        CREATE TEMP TABLE seen_sessions (sig BLOB PRIMARY KEY) WITHOUT ROWID
+    ''')
     # Collect all unique sessions in reverse order
     sessions_to_insert = []
 
-    for timestamp, source_file in files_with_times:
+    def file_digest_or_none(source_file):
         try:
-            source_conn = sqlite3.connect(str(source_file))
+            return _file_digest(source_file)
+        except OSError:
+            return None
+
+    # Read and hash the source files concurrently; each worker only
+    # reads, on its own connection, so the threads spend their time in
+    # I/O with the GIL released. Dedup stays on this thread so the
+    # newest-first, first-seen-wins ordering is unchanged.
+    if files_with_times:
+        with ThreadPoolExecutor(max_workers=min(8, len(files_with_times))) as executor:
+            digests = executor.map(
+                file_digest_or_none, (f for _, f in files_with_times))
+
+            unique_files = []
+            for (timestamp, source_file), file_sha in zip(files_with_times, digests):
+                if file_sha is not None:
+                    if file_sha in seen_files:
+                        continue
+                    seen_files.add(file_sha)
+                unique_files.append(source_file)
+
+            for candidates in executor.map(
+                    lambda f: _read_source_sessions(f, verbose=verbose),
+                    unique_files):
+                for candidate in candidates:
+                    session_signature = candidate.pop('signature')
+
+                    # Skip if we've seen this exact session before
+                    # Since we're going in reverse, we keep the most recent version
+                    cursor = target_conn.execute(
+                        'INSERT OR IGNORE INTO seen_sessions (sig) VALUES (?)',
+                        (session_signature,))
+                    if cursor.rowcount == 0:
+                        continue
+
+                    sessions_to_insert.append(candidate)
+
+    # Close the implicit transaction the temp-table inserts opened
+    target_conn.commit()
 
-            # Check if output_history table exists
-            cursor = source_conn.execute('''
-                SELECT name FROM sqlite_master
-                WHERE type='table' AND name='output_history'
-            ''')
-            has_output_history = cursor.fetchone() is not None
+    # Now insert sessions in chronological order (reverse of reverse order)
+    sessions_to_insert.sort(key=lambda d: d['metadata'][1] or d['metadata'][0])
 
-            # Get all sessions from this file in reverse order
-            sessions_cursor = source_conn.execute('''
-                SELECT session, start, end, num_cmds, remark
-                FROM sessions
-                ORDER BY session DESC
-            ''')
+    # Assign new session ids and remember, per source file, which original
+    # sessions map to which new ids
+    sessions_rows = []
+    session_map = {}  # source_file -> list of (orig_session, new_session)
 
-            for session_row in sessions_cursor:
-                orig_session, start_time, end_time, num_cmds, remark = session_row
-
-                # Get all commands for this session
-                history_cursor = source_conn.execute('''
-                    SELECT line, source, source_raw
-                    FROM history
-                    WHERE session = ?
-                    ORDER BY line
-                ''', (orig_session,))
-
-                commands = list(history_cursor)
-
-                # Get all outputs for this session (if table exists)
-                outputs = []
-                if has_output_history:
-                    output_cursor = source_conn.execute('''
-                        SELECT line, output
-                        FROM output_history
-                        WHERE session = ?
-                        ORDER BY line
-                    ''', (orig_session,))
-                    outputs = list(output_cursor)
-
-                # Create session signature: tuple of commands + outputs
-                commands_tuple = tuple(
-                    (line, source or "", source_raw or "")
-                    for line, source, source_raw in commands
-                )
-                outputs_tuple = tuple(
-                    (line, output or "")
-                    for line, output in outputs
-                )
-                session_signature = (commands_tuple, outputs_tuple)
+    next_session_id = 1
+    for session_data in sessions_to_insert:
+        start_time, end_time, num_cmds, remark = session_data['metadata']
 
-                # Skip if we've seen this exact session before
-                # Since we're going in reverse, we keep the most recent version
-                if session_signature in seen_sessions:
-                    continue
+        sessions_rows.append((next_session_id, start_time, end_time, num_cmds, remark))
+        session_map.setdefault(session_data['source_file'], []).append(
+            (session_data['orig_session'], next_session_id)
+        )
 
-                seen_sessions.add(session_signature)
+        next_session_id += 1
 
-                # Store the session data for later insertion
-                sessions_to_insert.append({
-                    'metadata': (start_time, end_time, num_cmds, remark),
-                    'commands': commands,
-                    'outputs': outputs
-                })
+    target_conn.execute("BEGIN")
+    _bulk_insert(
+        target_conn,
+        'INSERT INTO sessions (session, start, end, num_cmds, remark) VALUES ',
+        '(?,?,?,?,?)',
+        sessions_rows,
+    )
+    target_conn.commit()
 
-            source_conn.close()
+    # Copy history/output rows entirely inside SQLite: attach each source
+    # file and INSERT ... SELECT through a temp table mapping original
+    # session ids to the new ones, avoiding a Python round-trip per row
+    target_conn.execute('''
+        CREATE TEMP TABLE sig_map (orig INTEGER PRIMARY KEY, new INTEGER)
+    ''')
 
+    for source_file, id_pairs in session_map.items():
+        try:
+            # ATTACH cannot run inside a transaction, so each file gets
+            # its own short transaction
+            target_conn.execute("ATTACH DATABASE ? AS src", (str(source_file),))
         except sqlite3.Error as e:
             if verbose:
-                print(f"mergething: Warning: Could not read {source_file}: {e}")
+                print(f"mergething: Warning: Could not attach {source_file}: {e}")
             continue
 
-    # Now insert sessions in chronological order (reverse of reverse order)
-    sessions_to_insert.sort(key=lambda d: d['metadata'][1] or d['metadata'][0])
-
-    next_session_id = 1
-    for session_data in sessions_to_insert:
-        start_time, end_time, num_cmds, remark = session_data['metadata']
-
-        # Insert session metadata
-        target_conn.execute('''
-            INSERT INTO sessions (session, start, end, num_cmds, remark)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (next_session_id, start_time, end_time, num_cmds, remark))
+        try:
+            cursor = target_conn.execute('''
+                SELECT name FROM src.sqlite_master
+                WHERE type='table' AND name='output_history'
+            ''')
+            has_output_history = cursor.fetchone() is not None
 
-        # Insert all commands for this session
-        for line_num, source, source_raw in session_data['commands']:
+            target_conn.execute("BEGIN")
+            _bulk_insert(
+                target_conn, 'INSERT INTO sig_map (orig, new) VALUES ', '(?,?)', id_pairs
+            )
             target_conn.execute('''
                 INSERT INTO history (session, line, source, source_raw)
-                VALUES (?, ?, ?, ?)
-            ''', (next_session_id, line_num, source, source_raw))
-
-        # Insert all outputs for this session
-        for line_num, output in session_data['outputs']:
-            target_conn.execute('''
-                INSERT INTO output_history (session, line, output)
-                VALUES (?, ?, ?)
-            ''', (next_session_id, line_num, output))
+                SELECT m.new, h.line, h.source, h.source_raw
+                FROM src.history h JOIN sig_map m ON h.session = m.orig
+            ''')
+            if has_output_history:
+                target_conn.execute('''
+                    INSERT INTO output_history (session, line, output)
+                    SELECT m.new, o.line, o.output
+                    FROM src.output_history o JOIN sig_map m ON o.session = m.orig
+                ''')
+            target_conn.execute('DELETE FROM sig_map')
+            target_conn.commit()
+        except sqlite3.Error as e:
+            target_conn.rollback()
+            if verbose:
+                print(f"mergething: Warning: Could not copy rows from {source_file}: {e}")
+        finally:
+            target_conn.execute("DETACH DATABASE src")
 
-        next_session_id += 1
+    # Now that the load is done, recreate the (session, line) keys
+    target_conn.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS history_session_line
+        ON history (session, line)
+    ''')
+    target_conn.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS output_history_session_line
+        ON output_history (session, line)
+    ''')
 
-    target_conn.commit()
     target_conn.close()
     if verbose:
         print(f"mergething: Merged {len(files_with_times)} history files into {len(sessions_to_insert)} sessions")
@@ -257,37 +514,55 @@ def cleanup_old_files(sync_dir: Path, hostname: str, current_file: Path, safe_fi
     """Clean up old files from this machine and mark completed files from dead processes"""
     current_hostname = socket.gethostname()
 
+    # One scandir pass per directory covers both the dead-process check
+    # and the completed-file cleanup below
+    prefix = f"ipython_history_{hostname}_"
+    with os.scandir(sync_dir) as entries:
+        names = {e.name for e in entries if e.name.startswith(prefix)}
+
+    markers = _scan_marker_names(sync_dir, prefix)
+    for name in names:
+        if name.endswith(".db.completed"):
+            markers.setdefault(name, sync_dir / name)
+
     # First, check for files from dead processes and mark them as completed
     if hostname == current_hostname:
-        for file_path in sync_dir.glob(f"ipython_history_{hostname}_*.db"):
+        for name in names:
+            if not name.endswith(".db"):
+                continue
+            file_path = sync_dir / name
             if file_path == current_file:
                 continue
 
-            try:
-                # Parse the PID from filename: ipython_history_{hostname}_{pid}_{timestamp}.db
-                parts = file_path.stem.split('_')
-                if len(parts) >= 5:  # Has PID
-                    pid = int(parts[3])
-
-                    # Check if the process is still running
-                    if not is_process_running(pid):
-                        # Process is dead, mark the file as completed
-                        marker_file = sync_dir / f"{file_path.name}.completed"
-                        if not marker_file.exists():
-                            marker_file.touch()
-                            if verbose:
-                                print(f"mergething: Marked completed (process {pid} dead): {file_path}")
-            except (ValueError, IndexError):
+            # Parse the PID from filename: ipython_history_{hostname}_{pid}_{timestamp}.db
+            parsed = _parse_filename(name)
+            if parsed is None or parsed[1] is None:
                 continue
+            pid = parsed[1]
+
+            # Already marked: check against the scandir listing rather
+            # than stat'ing the marker, and skip the process poll
+            marker_name = f"{name}.completed"
+            if marker_name in markers:
+                continue
+
+            # Check if the process is still running
+            if not is_process_running(pid):
+                # Process is dead, mark the file as completed
+                completed_dir = sync_dir / _COMPLETED_DIR
+                completed_dir.mkdir(exist_ok=True)
+                (completed_dir / marker_name).touch()
+                if verbose:
+                    print(f"mergething: Marked completed (process {pid} dead): {file_path}")
 
     # Clean up old history files and their markers
-    for file_path in sync_dir.glob(f"ipython_history_{hostname}_*.db.completed"):
-        f = sync_dir / file_path.name[:-len(".completed")]
+    for marker_name, marker_path in markers.items():
+        f = sync_dir / marker_name[:-len(".completed")]
         if f == current_file or f not in safe_files:
             continue
 
         try:
-            file_path.unlink()
+            marker_path.unlink()
             f.unlink()
         except (ValueError, IndexError, OSError):
             continue
@@ -308,6 +583,7 @@ def sync_and_get_hist_file(sync_dir: Union[str, Path] = "~/syncthing/ipython_his
     """
     sync_dir = Path(sync_dir).expanduser()
     sync_dir.mkdir(parents=True, exist_ok=True)
+    (sync_dir / _COMPLETED_DIR).mkdir(exist_ok=True)
 
     if hostname is None:
         hostname = socket.gethostname()
@@ -326,16 +602,34 @@ def sync_and_get_hist_file(sync_dir: Union[str, Path] = "~/syncthing/ipython_his
         if verbose:
             print("mergething: No existing history files found, starting fresh.")
 
+    # Remember what the history file looked like at startup, so exit can
+    # tell whether this session ever wrote anything
+    try:
+        start_mtime = current_file.stat().st_mtime_ns
+    except OSError:
+        start_mtime = None
+
     # Register cleanup on exit
     def cleanup_on_exit():
         try:
             # Create an empty marker file to indicate this file is completed
             # This avoids conflicts with IPython's own history flushing
-            marker_file = sync_dir / f"{current_file.name}.completed"
+            marker_file = sync_dir / _COMPLETED_DIR / f"{current_file.name}.completed"
+            marker_file.parent.mkdir(exist_ok=True)
             marker_file.touch()
             if verbose:
                 print(f"mergething: Created completion marker: {marker_file}")
-            
+
+            # If the history file was never touched (shell opened and
+            # closed without running anything), skip the cleanup scan so
+            # no-op sessions exit instantly
+            try:
+                end_mtime = current_file.stat().st_mtime_ns
+            except OSError:
+                end_mtime = None
+            if end_mtime == start_mtime:
+                return
+
             # Now clean up old files from this machine
             # This happens after marking completion to avoid race conditions
             cleanup_old_files(sync_dir, hostname, current_file, safe_files, verbose=verbose)